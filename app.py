@@ -1,23 +1,94 @@
 import os
+import queue
 import sqlite3
+import threading
+import time
 import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from contextlib import contextmanager
 from urllib.parse import urlparse
-from flask import Flask, render_template, request, redirect, session, flash
+from flask import (
+    Flask, render_template, stream_template, request, redirect, session, flash,
+    get_flashed_messages, g, has_app_context, jsonify
+)
+from flask_caching import Cache
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "dev-secret-key")
 
+DATABASE_URL = os.environ.get("DATABASE_URL")
+USE_PG = bool(DATABASE_URL)
+PH = "%s" if USE_PG else "?"
+
+REDIS_URL = os.environ.get("REDIS_URL")
+
+if REDIS_URL:
+    cache = Cache(app, config={"CACHE_TYPE": "RedisCache", "CACHE_REDIS_URL": REDIS_URL})
+else:
+    cache = Cache(app, config={"CACHE_TYPE": "SimpleCache"})
+
+PRODUCTS_CACHE_KEY = "products_listing"
+PRODUCTS_VERSION_KEY = "products_version"
+# Bounds how long a listing (and its ETag) can outlive a change this process
+# did not see, e.g. a purchase handled by another worker
+PRODUCTS_CACHE_TIMEOUT = 60
+
+
+# =========================
+# SQL STATEMENTS
+# =========================
+class SQL:
+    select_user = f"SELECT password FROM staff WHERE email={PH}"
+    insert_user = (
+        f"INSERT INTO staff (email, password, role) VALUES ({PH}, {PH}, {PH}) "
+        "ON CONFLICT (email) DO NOTHING"
+    )
+    insert_product = f"INSERT INTO products (name, price, stock) VALUES ({PH}, {PH}, {PH})"
+    select_products = "SELECT id, name, price, stock FROM products"
+    select_products_by_name = select_products + " ORDER BY name ASC"
+    select_dashboard_totals = (
+        "SELECT COALESCE(SUM(total), 0), (SELECT COUNT(*) FROM staff) FROM purchases"
+    )
+    select_products_in = "SELECT id, name, price, stock FROM products WHERE id IN ({})"
+
+    if USE_PG:
+        # Lock the billed rows until commit; SQLite's BEGIN IMMEDIATE covers this
+        select_products_in += " FOR UPDATE"
+        update_stock_values = (
+            "UPDATE products AS p SET stock = p.stock - v.qty "
+            "FROM (VALUES %s) AS v(id, qty) WHERE p.id = v.id AND p.stock >= v.qty"
+        )
+        insert_purchase = "INSERT INTO purchases (total) VALUES (%s) RETURNING id"
+        # Expanded by execute_values into one multi-row INSERT
+        insert_purchase_items = (
+            "INSERT INTO purchase_items (purchase_id, product_name, quantity, price) VALUES %s"
+        )
+        insert_feedback = "INSERT INTO feedback (name, message) VALUES %s"
+    else:
+        update_stock_in = (
+            "UPDATE products SET stock = stock - (CASE id {0} END) "
+            "WHERE id IN ({1}) AND stock >= (CASE id {0} END)"
+        )
+        stock_case = "WHEN ? THEN ?"
+        # Databases created before the column default existed still need the
+        # timestamp supplied explicitly
+        insert_purchase = "INSERT INTO purchases (total, date) VALUES (?, datetime('now'))"
+        insert_purchase_items = (
+            "INSERT INTO purchase_items (purchase_id, product_name, quantity, price) VALUES (?, ?, ?, ?)"
+        )
+        insert_feedback = "INSERT INTO feedback (name, message) VALUES (?, ?)"
+
 
 # =========================
 # DATABASE CONNECTION
 # =========================
 def get_connection():
-    database_url = os.environ.get("DATABASE_URL")
-
-    if database_url:
-        url = urlparse(database_url)
+    if USE_PG:
+        url = urlparse(DATABASE_URL)
         return psycopg2.connect(
             dbname=url.path[1:],
             user=url.username,
@@ -26,19 +97,119 @@ def get_connection():
             port=url.port
         )
 
-    conn = sqlite3.connect("spectra.db")
-    conn.row_factory = sqlite3.Row
+    # Plain tuple rows; transactions are opened explicitly where needed
+    conn = sqlite3.connect("spectra.db", check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA mmap_size=268435456")
     return conn
 
 
+# =========================
+# CONNECTION POOL
+# =========================
+POOL_SIZE = min(32, (os.cpu_count() or 1) * 4)
+
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+
+if USE_PG:
+    PG_POOL = ThreadedConnectionPool(1, 20, dsn=DATABASE_URL)
+else:
+    for _ in range(POOL_SIZE):
+        _pool.put(get_connection())
+
+
+def _acquire():
+    if USE_PG:
+        return PG_POOL.getconn()
+    return _pool.get()
+
+
+def _release(conn):
+    # A connection that cannot be rolled back is discarded rather than
+    # leaking its pool slot
+    if USE_PG:
+        close = bool(conn.closed)
+        if not close and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                close = True
+        PG_POOL.putconn(conn, close=close)
+        return
+
+    if conn.in_transaction:
+        try:
+            conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            conn = get_connection()
+    _pool.put(conn)
+
+
+@contextmanager
+def get_conn():
+    conn = _acquire()
+    borrowed = g.setdefault("borrowed_conns", []) if has_app_context() else []
+    borrowed.append(conn)
+    try:
+        yield conn
+    finally:
+        borrowed.remove(conn)
+        _release(conn)
+
+
+@app.teardown_appcontext
+def return_borrowed_conns(exc):
+    for conn in g.pop("borrowed_conns", []):
+        _release(conn)
+
+
+# =========================
+# WAL CHECKPOINT
+# =========================
+WAL_CHECKPOINT_PAGES = 1000
+WAL_CHECKPOINT_INTERVAL = 60
+
+
+def wal_checkpointer():
+    conn = get_connection()
+    while True:
+        time.sleep(WAL_CHECKPOINT_INTERVAL)
+        try:
+            # A PASSIVE checkpoint copies whatever frames it can without
+            # waiting on readers or writers, and returns the WAL size in pages
+            _, wal_pages, _ = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+            if wal_pages > WAL_CHECKPOINT_PAGES:
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error:
+            app.logger.exception("WAL checkpoint failed")
+
+
+if not USE_PG:
+    threading.Thread(target=wal_checkpointer, daemon=True).start()
+
+
 # =========================
 # INIT DATABASE
 # =========================
+SCHEMA_VERSION = 1
+
+
 def init_db():
     conn = get_connection()
     c = conn.cursor()
 
-    if os.environ.get("DATABASE_URL"):
+    if not USE_PG:
+        # Skip the DDL entirely once this file has been initialised
+        c.execute("PRAGMA user_version")
+        if c.fetchone()[0] >= SCHEMA_VERSION:
+            conn.close()
+            return
+
+    if USE_PG:
         # PostgreSQL
 
         c.execute("""
@@ -85,6 +256,11 @@ def init_db():
         )
         """)
 
+        # No covering index on products: the purchase lookup is FOR UPDATE
+        # and must visit the heap anyway, and indexing stock would stop the
+        # stock decrements from being HOT updates
+        c.execute("DROP INDEX IF EXISTS idx_products_lookup")
+
     else:
         # SQLite
 
@@ -110,7 +286,7 @@ def init_db():
         CREATE TABLE IF NOT EXISTS purchases (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             total REAL,
-            date TEXT
+            date TEXT DEFAULT (datetime('now'))
         )
         """)
 
@@ -132,6 +308,13 @@ def init_db():
         )
         """)
 
+    # Same DDL on both engines
+    c.execute("CREATE INDEX IF NOT EXISTS idx_products_name ON products(name)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_purchase_items_purchase_id ON purchase_items(purchase_id)")
+
+    if not USE_PG:
+        c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
     conn.commit()
     conn.close()
 
@@ -164,16 +347,12 @@ def login():
             flash("All fields are required", "error")
             return redirect("/")
 
-        conn = get_connection()
-        c = conn.cursor()
+        with get_conn() as conn:
+            c = conn.cursor()
 
-        if os.environ.get("DATABASE_URL"):
-            c.execute("SELECT password FROM staff WHERE email=%s", (email,))
-        else:
-            c.execute("SELECT password FROM staff WHERE email=?", (email,))
+            c.execute(SQL.select_user, (email,))
 
-        user = c.fetchone()
-        conn.close()
+            user = c.fetchone()
 
         if not user:
             flash("Account does not exist", "error")
@@ -210,27 +389,16 @@ def signup():
 
         hashed = generate_password_hash(password)
 
-        conn = get_connection()
-        c = conn.cursor()
+        with get_conn() as conn:
+            c = conn.cursor()
 
-        try:
-            if os.environ.get("DATABASE_URL"):
-                c.execute(
-                    "INSERT INTO staff (email, password, role) VALUES (%s, %s, %s)",
-                    (email, hashed, "staff")
-                )
-            else:
-                c.execute(
-                    "INSERT INTO staff (email, password, role) VALUES (?, ?, ?)",
-                    (email, hashed, "staff")
-                )
+            c.execute(SQL.insert_user, (email, hashed, "staff"))
             conn.commit()
-        except:
-            flash("Email already registered", "error")
-            conn.close()
-            return redirect("/signup")
 
-        conn.close()
+            if c.rowcount == 0:
+                flash("Email already registered", "error")
+                return redirect("/signup")
+
         flash("Account created successfully", "success")
         return redirect("/")
 
@@ -250,23 +418,14 @@ def logout():
 @login_required
 def dashboard():
 
-    conn = get_connection()
-    c = conn.cursor()
-
-    c.execute("SELECT id, name, price, stock FROM products ORDER BY name ASC")
-    products = c.fetchall()
-
-    if os.environ.get("DATABASE_URL"):
-        c.execute("SELECT COALESCE(SUM(total), 0) FROM purchases")
-    else:
-        c.execute("SELECT IFNULL(SUM(total), 0) FROM purchases")
-
-    total_sales = c.fetchone()[0] or 0
+    with get_conn() as conn:
+        c = conn.cursor()
 
-    c.execute("SELECT COUNT(*) FROM staff")
-    total_users = c.fetchone()[0] or 0
+        c.execute(SQL.select_products_by_name)
+        products = c.fetchall()
 
-    conn.close()
+        c.execute(SQL.select_dashboard_totals)
+        total_sales, total_users = c.fetchone()
 
     return render_template(
         "dashboard.html",
@@ -286,22 +445,14 @@ def add_product():
     price = float(request.form["price"])
     stock = int(request.form["stock"])
 
-    conn = get_connection()
-    c = conn.cursor()
+    with get_conn() as conn:
+        c = conn.cursor()
 
-    if os.environ.get("DATABASE_URL"):
-        c.execute(
-            "INSERT INTO products (name, price, stock) VALUES (%s, %s, %s)",
-            (name, price, stock)
-        )
-    else:
-        c.execute(
-            "INSERT INTO products (name, price, stock) VALUES (?, ?, ?)",
-            (name, price, stock)
-        )
+        c.execute(SQL.insert_product, (name, price, stock))
 
-    conn.commit()
-    conn.close()
+        conn.commit()
+
+    invalidate_products()
 
     flash("Product added successfully", "success")
     return redirect("/dashboard")
@@ -310,20 +461,71 @@ def add_product():
 # =========================
 # PURCHASE PAGE (GET)
 # =========================
+def products_version():
+    version = cache.get(PRODUCTS_VERSION_KEY)
+    if version is None:
+        version = str(time.time_ns())
+        cache.set(PRODUCTS_VERSION_KEY, version, timeout=PRODUCTS_CACHE_TIMEOUT)
+    return version
+
+
+def invalidate_products():
+    # Rows are cached per version, so a new version retires the old listing
+    cache.set(PRODUCTS_VERSION_KEY, str(time.time_ns()), timeout=PRODUCTS_CACHE_TIMEOUT)
+
+
+def set_listing_cache_headers(response, version):
+    response.set_etag(version, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
 @app.route("/purchase", methods=["GET"])
 @login_required
 def purchase_page():
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT id, name, price, stock FROM products")
-    products = c.fetchall()
-    conn.close()
-    return render_template("purchase.html", products=products)
+    version = products_version()
+
+    # A pending flash still has to be rendered, so only revalidate without one
+    if "_flashes" not in session and request.if_none_match.contains_weak(version):
+        return set_listing_cache_headers(app.response_class(status=304), version)
+
+    # The rendered page carries flash messages, so only the rows are cached.
+    # Keying them by version means rows read before a purchase committed can
+    # never be served under the version that purchase created
+    rows_key = f"{PRODUCTS_CACHE_KEY}:{version}"
+    products = cache.get(rows_key)
+
+    if products is None:
+        with get_conn() as conn:
+            c = conn.cursor()
+            c.execute(SQL.select_products)
+            products = c.fetchall()
+        cache.set(rows_key, products, timeout=PRODUCTS_CACHE_TIMEOUT)
+
+    # The session is saved before a streamed body renders, so pop the flashes
+    # now; layout.html then reads the copy cached on the request
+    get_flashed_messages()
+    response = app.response_class(stream_template("purchase.html", products=products))
+    return set_listing_cache_headers(response, version)
 
 
 # =========================
 # PURCHASE (POST)
 # =========================
+MAX_PRODUCT_ID = 2 ** 63 - 1
+
+
+def purchase_error(message):
+    # Scripted clients get the error inline instead of a redirect round-trip
+    if (request.headers.get("X-Requested-With") == "XMLHttpRequest"
+            or request.accept_mimetypes.best == "application/json"):
+        return jsonify({"error": message}), 400
+
+    flash(message, "error")
+    return redirect("/purchase", code=303)
+
+
 @app.route("/purchase", methods=["POST"])
 @login_required
 def purchase():
@@ -332,68 +534,138 @@ def purchase():
     quantities = request.form.getlist("quantity[]")
 
     if not product_ids:
-        flash("No items selected", "error")
-        return redirect("/purchase")
+        return purchase_error("No items selected")
 
-    conn = get_connection()
-    c = conn.cursor()
+    try:
+        product_ids = list(map(int, product_ids))
+    except ValueError:
+        return purchase_error("Product not found")
 
-    total = 0
-    selected = set()
+    # Ids outside the 64-bit range cannot exist and SQLite refuses to bind them
+    if not all(0 < pid <= MAX_PRODUCT_ID for pid in product_ids):
+        return purchase_error("Product not found")
 
-    for i in range(len(product_ids)):
+    if len(set(product_ids)) != len(product_ids):
+        return purchase_error("Duplicate product not allowed")
 
-        product_id = product_ids[i]
-        qty = int(quantities[i])
+    try:
+        qtys = list(map(int, quantities))
+    except ValueError:
+        qtys = []
 
-        if product_id in selected:
-            flash("Duplicate product not allowed", "error")
-            conn.close()
-            return redirect("/purchase")
+    if len(qtys) != len(product_ids) or min(qtys, default=0) <= 0:
+        return purchase_error("Invalid quantity")
 
-        selected.add(product_id)
+    with get_conn() as conn:
+        c = conn.cursor()
 
-        if os.environ.get("DATABASE_URL"):
-            c.execute("SELECT name, price, stock FROM products WHERE id=%s", (product_id,))
-        else:
-            c.execute("SELECT name, price, stock FROM products WHERE id=?", (product_id,))
+        try:
+            if not USE_PG:
+                c.execute("BEGIN IMMEDIATE")
 
-        product = c.fetchone()
+            placeholders = ",".join([PH] * len(product_ids))
+            c.execute(SQL.select_products_in.format(placeholders), product_ids)
+            rows = {row[0]: row for row in c.fetchall()}
 
-        if not product:
-            flash("Product not found", "error")
-            conn.close()
-            return redirect("/purchase")
+            total = 0
+            updates = []
+            lines = []
 
-        name, price, stock = product
+            for product_id, qty in zip(product_ids, qtys):
+                product = rows.get(product_id)
 
-        if qty > stock:
-            flash(f"Not enough stock for {name}", "error")
-            conn.close()
-            return redirect("/purchase")
+                if not product:
+                    conn.rollback()
+                    return purchase_error("Product not found")
 
-        total += float(price) * qty
+                pid, name, price, stock = product
 
-        if os.environ.get("DATABASE_URL"):
-            c.execute("UPDATE products SET stock = stock - %s WHERE id=%s", (qty, product_id))
-        else:
-            c.execute("UPDATE products SET stock = stock - ? WHERE id=?", (qty, product_id))
+                if qty > stock:
+                    conn.rollback()
+                    return purchase_error(f"Not enough stock for {name}")
 
-    if os.environ.get("DATABASE_URL"):
-        c.execute("INSERT INTO purchases (total) VALUES (%s)", (total,))
-    else:
-        c.execute("INSERT INTO purchases (total, date) VALUES (?, datetime('now'))", (total,))
+                total += price * qty
+                updates.append((pid, qty))
+                lines.append((name, qty, price))
 
-    conn.commit()
-    conn.close()
+            if USE_PG:
+                execute_values(c, SQL.update_stock_values, updates, page_size=len(updates))
+            else:
+                cases = " ".join([SQL.stock_case] * len(updates))
+                case_params = [value for pair in updates for value in pair]
+                params = case_params + [pid for pid, _ in updates] + case_params
+                c.execute(SQL.update_stock_in.format(cases, placeholders), params)
+
+            # The stock guard skips any row that a concurrent bill drained
+            if c.rowcount != len(updates):
+                conn.rollback()
+                return purchase_error("Not enough stock")
+
+            c.execute(SQL.insert_purchase, (total,))
+            purchase_id = c.fetchone()[0] if USE_PG else c.lastrowid
+
+            items = [(purchase_id, name, qty, price) for name, qty, price in lines]
+            if USE_PG:
+                execute_values(c, SQL.insert_purchase_items, items)
+            else:
+                c.executemany(SQL.insert_purchase_items, items)
+
+            conn.commit()
+        except Exception:
+            # Keep the original error; _release() discards a broken connection
+            try:
+                conn.rollback()
+            except (sqlite3.Error, psycopg2.Error):
+                pass
+            raise
+
+    invalidate_products()
 
     flash("Purchase completed successfully", "success")
-    return redirect("/dashboard")
+    return redirect("/dashboard", code=303)
 
 
 # =========================
 # FEEDBACK
 # =========================
+FEEDBACK_BATCH_SIZE = 500
+FEEDBACK_FLUSH_INTERVAL = 0.1
+
+_feedback_queue = queue.Queue()
+
+
+def feedback_writer():
+    while True:
+        # Block for the first row, then collect more until the batch is full
+        # or the flush interval runs out
+        batch = [_feedback_queue.get()]
+        deadline = time.monotonic() + FEEDBACK_FLUSH_INTERVAL
+
+        while len(batch) < FEEDBACK_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_feedback_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        try:
+            with get_conn() as conn:
+                c = conn.cursor()
+                if USE_PG:
+                    execute_values(c, SQL.insert_feedback, batch, page_size=len(batch))
+                else:
+                    c.execute("BEGIN")
+                    c.executemany(SQL.insert_feedback, batch)
+                conn.commit()
+        except Exception:
+            app.logger.exception("Could not save %d feedback entries", len(batch))
+
+
+threading.Thread(target=feedback_writer, daemon=True).start()
+
+
 @app.route("/feedback", methods=["GET", "POST"])
 @login_required
 def feedback():
@@ -406,16 +678,8 @@ def feedback():
             flash("All fields are required", "error")
             return redirect("/feedback")
 
-        conn = get_connection()
-        c = conn.cursor()
-
-        if os.environ.get("DATABASE_URL"):
-            c.execute("INSERT INTO feedback (name, message) VALUES (%s, %s)", (name, message))
-        else:
-            c.execute("INSERT INTO feedback (name, message) VALUES (?, ?)", (name, message))
-
-        conn.commit()
-        conn.close()
+        # Written by feedback_writer so the response never waits on the DB
+        _feedback_queue.put((name, message))
 
         flash("Feedback submitted successfully", "success")
         return redirect("/feedback")